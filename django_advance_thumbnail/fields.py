@@ -4,16 +4,66 @@ import os
 from PIL import Image, ImageOps
 from django.core.files import File
 from django.db import models
+from django.db.models.fields.files import FieldFile, ImageFieldFile
+from django.utils.functional import cached_property
+
+try:
+    import pyvips
+except (ImportError, OSError):
+    # pyvips raises OSError when the package is installed but the libvips library is not
+    pyvips = None
+
+# Output format for each source extension; anything else is written as JPEG
+_FORMAT_BY_EXT = {
+    '.jpg': 'JPEG',
+    '.jpeg': 'JPEG',
+    '.png': 'PNG',
+    '.webp': 'WEBP',
+    '.gif': 'GIF',
+    '.bmp': 'BMP',
+}
+
+# Embedded metadata that must not be copied into thumbnails (EXIF may carry GPS coordinates)
+_METADATA_KEYS = ('exif', 'xmp', 'icc_profile')
+
+# Formats the libvips backend writes; the rest go through Pillow
+_VIPS_SUFFIX_BY_FORMAT = {
+    'JPEG': '.jpg',
+    'PNG': '.png',
+    'WEBP': '.webp',
+}
+
+
+class AdvanceThumbnailFieldFile(ImageFieldFile):
+    def _require_file(self):
+        # Lazy thumbnails are generated on first access to url, path, size or the file itself
+        if self.field.lazy:
+            self.field.generate_thumbnail(self.instance)
+            self.name = getattr(self.instance, self.field.attname).name
+        super()._require_file()
 
 
 class AdvanceThumbnailField(models.ImageField):
+    attr_class = AdvanceThumbnailFieldFile
+
+    # Set to 'vips' to generate thumbnails with libvips when pyvips is installed
+    BACKEND = 'pillow'
+    # Sources above this many pixels are rejected from their header, before decoding; None disables the check
+    MAX_SOURCE_PIXELS = 100_000_000
+
     def __init__(self, *args, **kwargs):
         self.source_field_name = kwargs.pop('source_field', None)
         self.size = kwargs.pop('size', (300, 300))
+        self.optimize = kwargs.pop('optimize', False)
+        self.lazy = kwargs.pop('lazy', False)
         super().__init__(*args, **kwargs)
 
     def contribute_to_class(self, cls, name, **kwargs):
         super().contribute_to_class(cls, name, **kwargs)
+        # Instance attribute holding the source name the stored thumbnail was generated from
+        self._source_name_attr = f"_{name}_source_name"
+        models.signals.post_init.connect(self.store_source_name, sender=cls)
+        models.signals.pre_save.connect(self.track_source_change, sender=cls)
         models.signals.post_save.connect(self.create_thumbnail, sender=cls)
 
     def pre_save(self, model_instance, add):
@@ -23,44 +73,252 @@ class AdvanceThumbnailField(models.ImageField):
             file.delete(save=False)
         return file
 
+    def store_source_name(self, instance, **kwargs):
+        # Only the first field sharing the source reads the recorded name
+        if self._source_fields[0] is not self:
+            return
+
+        # Remember which source file the stored thumbnail belongs to; a deferred source is left unrecorded
+        if self.source_field_name not in instance.__dict__:
+            return
+
+        value = instance.__dict__[self.source_field_name]
+        # Sources with width_field/height_field are already wrapped by ImageField's own post_init receiver
+        if isinstance(value, FieldFile):
+            value = value.name
+        instance.__dict__[self._source_name_attr] = value if isinstance(value, str) else None
+
+    def track_source_change(self, instance, **kwargs):
+        if self._source_fields[0] is not self:
+            return
+
+        # Leave deferred sources unloaded and skip saves that do not write the source
+        update_fields = kwargs.get('update_fields')
+        if self.source_field_name not in instance.__dict__ or (
+            update_fields is not None and self.source_field_name not in update_fields
+        ):
+            return
+
+        # A newly assigned file may reuse the old name (e.g. overwriting storages), so forget the stored name
+        source_field = getattr(instance, self.source_field_name)
+        if source_field and not source_field._committed:
+            instance.__dict__[self._source_name_attr] = None
+
     def create_thumbnail(self, instance, **kwargs):
+        # Nothing to do when the save did not touch the source field
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and self.source_field_name not in update_fields:
+            return
+
         source_field = getattr(instance, self.source_field_name)
         if not source_field or not source_field.name:
             return
 
-        # Disconnect the signal before creating and saving the thumbnail
-        models.signals.post_save.disconnect(self.create_thumbnail, sender=instance.__class__)
+        # The first field sharing this source generates the thumbnails for all of them
+        fields = self._source_fields
+        if fields[0] is not self:
+            return
+
+        if not self._has_source_changed(instance, source_field, fields):
+            return
+
+        if self.lazy:
+            self._clear_thumbnails(instance, fields)
+        else:
+            self._save_thumbnails(instance, source_field, fields)
+
+    def generate_thumbnail(self, instance):
+        # Stale lazy thumbnails are already cleared on save, so only missing ones need generating
+        fields = self._source_fields
+        if instance.pk is None or all(getattr(instance, field.attname) for field in fields):
+            return
+
+        source_field = getattr(instance, self.source_field_name)
+        if source_field and source_field.name:
+            fields[0]._save_thumbnails(instance, source_field, fields)
+
+    def _save_thumbnails(self, instance, source_field, fields):
+        for field, thumbnail_file in zip(fields, self._generate_thumbnail_files(source_field, fields)):
+            getattr(instance, field.attname).save(thumbnail_file.name, thumbnail_file, save=False)
+
+        # Write only the thumbnail columns; a queryset update sends no signals, so post_save is not re-entered
+        instance.__class__._base_manager.using(instance._state.db).filter(pk=instance.pk).update(
+            **{field.attname: getattr(instance, field.attname).name for field in fields}
+        )
+        instance.__dict__[self._source_name_attr] = source_field.name
+
+    def _clear_thumbnails(self, instance, fields):
+        # Stale lazy thumbnails are dropped on save and regenerated on their next access
+        stale_fields = [field for field in fields if getattr(instance, field.attname)]
+        if not stale_fields:
+            return
 
+        instance.__class__._base_manager.using(instance._state.db).filter(pk=instance.pk).update(
+            **{field.attname: '' for field in stale_fields}
+        )
+        for field in stale_fields:
+            getattr(instance, field.attname).name = None
+
+    def _has_source_changed(self, instance, source_field, fields):
+        # No recorded name means the source was deferred at load, so the thumbnail may belong to another file
+        if instance.__dict__.get(self._source_name_attr) != source_field.name:
+            return True
+        if not all(getattr(instance, field.attname) for field in fields):
+            return True
+        # Same name: the file may still have been overwritten in place by a storage that reuses names
+        return self._is_source_newer(source_field, getattr(instance, self.attname))
+
+    def _is_source_newer(self, source_field, thumbnail_field):
         try:
-            with source_field.open() as source_file:
-                img = Image.open(source_file)
+            return (
+                source_field.storage.get_modified_time(source_field.name)
+                > thumbnail_field.storage.get_modified_time(thumbnail_field.name)
+            )
+        except (NotImplementedError, OSError):
+            # Without modification times there is no way to tell, so regenerate to be safe
+            return True
+
+    @cached_property
+    def _source_fields(self):
+        # Computed once per field, on first use after the model is fully prepared
+        return [
+            field for field in self.model._meta.concrete_fields
+            if type(field) is type(self)
+            and field.source_field_name == self.source_field_name
+            and field.lazy == self.lazy
+        ]
+
+    def _generate_thumbnail_files(self, source_field, fields):
+        filename, extension = os.path.splitext(os.path.basename(source_field.name))
+        thumbnail_filename = f"{filename}_thumbnail{extension}"
+
+        # Determine the format based on the file extension, fallback to JPEG if not found
+        image_format = _FORMAT_BY_EXT.get(extension.lower(), 'JPEG')
+
+        if self.BACKEND == 'vips' and pyvips is not None and image_format in _VIPS_SUFFIX_BY_FORMAT:
+            path = self._local_source_path(source_field)
+            if path is not None:
+                buffer = None
+                self._check_source_size(pyvips.Image.new_from_file(path))
+            else:
+                with source_field.open('rb') as source_file:
+                    buffer = source_file.read()
+                self._check_source_size(pyvips.Image.new_from_buffer(buffer, ''))
+            return [
+                File(io.BytesIO(field._generate_vips_thumbnail(path, buffer, image_format)), name=thumbnail_filename)
+                for field in fields
+            ]
 
-                # Handle orientation from EXIF data
+        thumbnail_files = []
+        with self._open_source_file(source_field) as source_file:
+            img = Image.open(source_file)
+            self._check_source_size(img)
+
+            orientation = img.getexif().get(0x0112, 1)
+
+            if (
+                orientation == 1
+                and img.format == image_format
+                and self._fits_within(img, fields)
+                and not any(key in img.info for key in _METADATA_KEYS)
+            ):
+                # The source already fits every thumbnail box; store its bytes instead of decoding and re-encoding
+                source_file.seek(0)
+                data = source_file.read()
+                return [File(io.BytesIO(data), name=thumbnail_filename) for field in fields]
+
+            if img.format == 'JPEG':
+                # Let libjpeg decode at a reduced scale; must happen before any pixel access
+                img.draft('RGB', self._draft_size(orientation, fields))
+
+            # Handle orientation from EXIF data; exif_transpose() copies the image even when there is nothing to do
+            if orientation != 1:
                 img = ImageOps.exif_transpose(img)
 
-                img.thumbnail(self.size)
+            # Decode the source once and resize a copy for every field
+            img.load()
+            for index, field in enumerate(fields):
+                # The last field can resize the decoded image in place
+                img_copy = img if index == len(fields) - 1 else img.copy()
+                img_copy.thumbnail(field.size)
 
-                filename, extension = os.path.splitext(os.path.basename(source_field.name))
-                thumbnail_filename = f"{filename}_thumbnail{extension}"
+                if image_format == 'JPEG' and img_copy.mode not in ('RGB', 'L', 'CMYK'):
+                    img_copy = self._flatten_alpha(img_copy)
 
                 thumbnail_io = io.BytesIO()
+                img_copy.save(thumbnail_io, format=image_format, **field._save_options(image_format))
+                thumbnail_io.seek(0)
+                thumbnail_files.append(File(thumbnail_io, name=thumbnail_filename))
 
-                # Determine the format based on the file extension, fallback to JPEG if not found
-                if extension.lower() in ['.jpg', '.jpeg']:
-                    image_format = 'JPEG'
-                elif extension.lower() == '.png':
-                    image_format = 'PNG'
-                else:
-                    image_format = 'JPEG'  # Default to JPEG if unsure
+        return thumbnail_files
 
-                img.save(thumbnail_io, format=image_format)
-                thumbnail_io.seek(0)
+    def _fits_within(self, img, fields):
+        return all(img.width <= field.size[0] and img.height <= field.size[1] for field in fields)
+
+    def _check_source_size(self, img):
+        # Only the image header has been read at this point
+        if self.MAX_SOURCE_PIXELS is not None and img.width * img.height > self.MAX_SOURCE_PIXELS:
+            raise ValueError(
+                f"Source image is {img.width}x{img.height} pixels, "
+                f"which exceeds the {self.MAX_SOURCE_PIXELS} pixel limit for thumbnails."
+            )
+
+    def _save_options(self, image_format):
+        # The extra optimize pass costs encode time for a few percent smaller files, so it is opt-in
+        if image_format == 'JPEG':
+            return {'optimize': self.optimize}
+        if image_format == 'PNG':
+            # zlib level 1 is several times faster than the default level 6 and thumbnails are small anyway
+            return {'optimize': True} if self.optimize else {'compress_level': 1}
+        if image_format == 'WEBP':
+            # method 0 is the fastest WebP encoder setting; Pillow defaults to 4
+            return {'method': 6 if self.optimize else 0}
+        return {}
+
+    def _flatten_alpha(self, img):
+        # JPEG has no alpha channel, so composite transparent and palette images onto white
+        img = img.convert('RGBA')
+        background = Image.new('RGBA', img.size, (255, 255, 255, 255))
+        return Image.alpha_composite(background, img).convert('RGB')
+
+    def _local_source_path(self, source_field):
+        try:
+            path = source_field.path
+        except NotImplementedError:
+            return None
+        # Some storages (e.g. InMemoryStorage) report a path that is not on disk
+        return path if os.path.exists(path) else None
+
+    def _open_source_file(self, source_field):
+        # Read straight from disk when the storage has local paths, skipping the storage file wrapper
+        path = self._local_source_path(source_field)
+        if path is not None:
+            return open(path, 'rb')
+        return source_field.open('rb')
+
+    def _draft_size(self, orientation, fields):
+        # Keep a 2x margin over the largest box, as thumbnail()'s reducing_gap does, for the final resample
+        width = max(field.size[0] for field in fields) * 2
+        height = max(field.size[1] for field in fields) * 2
 
-                thumbnail_file = File(thumbnail_io, name=thumbnail_filename)
-                setattr(instance, self.name, thumbnail_file)
+        # Orientations 5-8 swap width and height once the image is transposed
+        if orientation in (5, 6, 7, 8):
+            return height, width
+        return width, height
 
-                instance.save(update_fields=[self.name])
+    def _generate_vips_thumbnail(self, path, buffer, image_format):
+        # libvips decodes and shrinks in one pass (shrink-on-load), rotates from EXIF and never upscales
+        width, height = self.size
+        options = {'height': height, 'size': 'down', 'import_profile': 'srgb'}
+        if path is not None:
+            # Streams from disk, so the encoded source is never held in memory
+            img = pyvips.Image.thumbnail(path, width, **options)
+        else:
+            img = pyvips.Image.thumbnail_buffer(buffer, width, **options)
 
-        finally:
-            # Reconnect the signal after saving
-            models.signals.post_save.connect(self.create_thumbnail, sender=instance.__class__)
+        if image_format == 'JPEG':
+            return img.write_to_buffer('.jpg[Q=75,optimize_coding,strip]' if self.optimize else '.jpg[Q=75,strip]')
+        if image_format == 'PNG':
+            # Same trade-off as the Pillow path: fast zlib level 1 unless optimize is set
+            return img.write_to_buffer('.png[compression=9,strip]' if self.optimize else '.png[compression=1,strip]')
+        return img.write_to_buffer(f"{_VIPS_SUFFIX_BY_FORMAT[image_format]}[strip]")
@@ -1,3 +1,185 @@
-from django.test import TestCase
+import io
+import os
+import shutil
+import tempfile
+import time
 
-# Create your tests here.
+from PIL import Image
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.db import connection, models
+from django.test import TestCase, override_settings
+
+from .fields import AdvanceThumbnailField
+
+
+class OverwriteStorage(FileSystemStorage):
+    # Reuses the uploaded name instead of picking a free one, like many cloud storage setups
+    def get_available_name(self, name, max_length=None):
+        self.delete(name)
+        return name
+
+
+class EagerThumbnailModel(models.Model):
+    image = models.ImageField(upload_to='images/', storage=OverwriteStorage(), null=True, blank=True)
+    thumbnail = AdvanceThumbnailField(source_field='image', upload_to='thumbnails/', null=True, blank=True,
+                                      size=(100, 100))
+    title = models.CharField(max_length=50, blank=True)
+
+    class Meta:
+        app_label = 'django_advance_thumbnail'
+
+
+class LazyThumbnailModel(models.Model):
+    image = models.ImageField(upload_to='images/', null=True, blank=True)
+    thumbnail = AdvanceThumbnailField(source_field='image', upload_to='thumbnails/', null=True, blank=True,
+                                      size=(100, 100), lazy=True)
+
+    class Meta:
+        app_label = 'django_advance_thumbnail'
+
+
+def create_image_file(color='red', size=(300, 900), image_format='JPEG', **save_options):
+    image_io = io.BytesIO()
+    Image.new('RGB', size, color).save(image_io, format=image_format, **save_options)
+    return ContentFile(image_io.getvalue())
+
+
+def thumbnail_color(thumbnail):
+    with Image.open(thumbnail.path) as img:
+        return img.convert('RGB').getpixel((img.width // 2, img.height // 2))
+
+
+def age_file(path, seconds=60):
+    timestamp = time.time() - seconds
+    os.utime(path, (timestamp, timestamp))
+
+
+class ThumbnailTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # The test models have no migrations, so create their tables directly
+        with connection.schema_editor() as schema_editor:
+            schema_editor.create_model(EagerThumbnailModel)
+            schema_editor.create_model(LazyThumbnailModel)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        with connection.schema_editor() as schema_editor:
+            schema_editor.delete_model(EagerThumbnailModel)
+            schema_editor.delete_model(LazyThumbnailModel)
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def create_eager(self, name='a.jpg', color='red'):
+        obj = EagerThumbnailModel()
+        obj.image.save(name, create_image_file(color))
+        return obj
+
+
+class EagerThumbnailTests(ThumbnailTestCase):
+    def test_thumbnail_is_created(self):
+        obj = self.create_eager()
+
+        self.assertTrue(obj.thumbnail)
+        self.assertEqual(obj.thumbnail.name, EagerThumbnailModel.objects.get(pk=obj.pk).thumbnail.name)
+        with Image.open(obj.thumbnail.path) as img:
+            self.assertEqual(img.size, (33, 100))
+
+    def test_new_source_regenerates_thumbnail(self):
+        obj = self.create_eager()
+        old_thumbnail = obj.thumbnail.name
+
+        obj.image.save('b.jpg', create_image_file('blue'))
+
+        self.assertNotEqual(obj.thumbnail.name, old_thumbnail)
+        self.assertEqual(thumbnail_color(obj.thumbnail), (0, 0, 254))
+
+    def test_unchanged_save_keeps_thumbnail(self):
+        obj = self.create_eager()
+        old_thumbnail = obj.thumbnail.name
+
+        obj = EagerThumbnailModel.objects.get(pk=obj.pk)
+        obj.title = 'changed'
+        obj.save()
+
+        self.assertEqual(obj.thumbnail.name, old_thumbnail)
+        self.assertEqual(EagerThumbnailModel.objects.get(pk=obj.pk).thumbnail.name, old_thumbnail)
+
+    def test_overwritten_source_regenerates_thumbnail(self):
+        obj = self.create_eager(name='same.jpg')
+        age_file(obj.image.path)
+        age_file(obj.thumbnail.path)
+
+        obj = EagerThumbnailModel.objects.get(pk=obj.pk)
+        obj.image.save('same.jpg', create_image_file('blue'))
+
+        self.assertEqual(obj.image.name, 'images/same.jpg')
+        self.assertEqual(thumbnail_color(obj.thumbnail), (0, 0, 254))
+
+    def test_small_source_is_copied(self):
+        obj = EagerThumbnailModel()
+        obj.image.save('small.jpg', create_image_file(size=(80, 60)))
+
+        with open(obj.image.path, 'rb') as source, open(obj.thumbnail.path, 'rb') as thumbnail:
+            self.assertEqual(source.read(), thumbnail.read())
+
+    def test_small_source_metadata_is_stripped(self):
+        exif = Image.Exif()
+        exif[0x010F] = 'Camera maker'
+        obj = EagerThumbnailModel()
+        obj.image.save('small.jpg', create_image_file(size=(80, 60), exif=exif))
+
+        with Image.open(obj.thumbnail.path) as img:
+            self.assertEqual(img.size, (80, 60))
+            self.assertNotIn('exif', img.info)
+
+    def test_deferred_save_skips_source(self):
+        obj = self.create_eager()
+        obj = EagerThumbnailModel.objects.defer('image').get(pk=obj.pk)
+        obj.title = 'changed'
+
+        with self.assertNumQueries(1):
+            obj.save(update_fields=['title'])
+
+    def test_deferred_source_reassigned_regenerates_thumbnail(self):
+        first = self.create_eager(name='a.jpg', color='red')
+        second = self.create_eager(name='b.jpg', color='blue')
+        # Older than the first thumbnail, so only the name tells the sources apart
+        age_file(second.image.path)
+
+        obj = EagerThumbnailModel.objects.defer('image').get(pk=first.pk)
+        obj.image = second.image.name
+        obj.save()
+
+        self.assertEqual(thumbnail_color(obj.thumbnail), (0, 0, 254))
+        self.assertEqual(EagerThumbnailModel.objects.get(pk=obj.pk).thumbnail.name, obj.thumbnail.name)
+
+
+class LazyThumbnailTests(ThumbnailTestCase):
+    def test_thumbnail_is_generated_on_first_access(self):
+        obj = LazyThumbnailModel()
+        obj.image.save('a.jpg', create_image_file())
+        self.assertFalse(obj.thumbnail)
+
+        obj = LazyThumbnailModel.objects.get(pk=obj.pk)
+        self.assertTrue(obj.thumbnail.url)
+        self.assertEqual(LazyThumbnailModel.objects.get(pk=obj.pk).thumbnail.name, obj.thumbnail.name)
+
+    def test_new_source_clears_and_regenerates_thumbnail(self):
+        obj = LazyThumbnailModel()
+        obj.image.save('a.jpg', create_image_file('red'))
+        obj.thumbnail.path
+
+        obj.image.save('b.jpg', create_image_file('blue'))
+        self.assertFalse(obj.thumbnail)
+        self.assertFalse(LazyThumbnailModel.objects.get(pk=obj.pk).thumbnail)
+
+        self.assertEqual(thumbnail_color(obj.thumbnail), (0, 0, 254))